@@ -208,7 +208,7 @@ class Generator:
         segments = song.segments() 
         segment = segments[segidx] if segidx < len(segments) else None
         if segment:
-            segment_length = segment.track_length() if segment.track_length() else song.default_track_length()
+            segment_length = segment.track_length() or song.default_track_length()
             tokens = segment.merged_stage1_tracks() if use_cache else []
             return 2 * segment_length - len(tokens), self._stage1_pipeline.tokenize_segment_text(str(segment), tokens, segidx == 0, False)
 
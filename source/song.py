@@ -1,10 +1,24 @@
+# Hot paths in this module are allocation bound rather than compute bound: keep
+# tracks as numpy arrays and slice views, concatenate once instead of per segment
+# and avoid deepcopy when cloning songs or segments.
+import base64
 import copy
-from itertools import takewhile
-import re
+from functools import lru_cache
 
-from einops import rearrange
 import numpy as np
 
+def _empty_track(elem_size):
+    track = np.empty((0, elem_size), dtype=np.int64)
+    track.flags.writeable = False
+    return track
+
+_SAVED_TRACK_DTYPE = np.dtype("<i4")
+
+# Shared read-only empty track per stage, stage 2 holds 8 codebook entries per token
+_EMPTY_STAGE_TRACKS = (_empty_track(1), _empty_track(8))
+
+# Tag values repeat on every reparse of the lyrics, cache the conversions
+@lru_cache(maxsize=1024)
 def parse_tag(tag_name, tag_data):
     if tag_name == "length":
         if tag_data.endswith('t'):
@@ -12,16 +26,67 @@ def parse_tag(tag_name, tag_data):
         return int(float(tag_data) * 50)
     return tag_data
 
+# Find the next [name] section header at or after pos, returns the bracket positions
+def _find_section(lyrics, pos):
+    close = -1
+    while True:
+        start = lyrics.find('[', pos)
+        if start < 0:
+            return None
+        if close <= start:
+            close = lyrics.find(']', start + 1)
+            if close < 0:
+                return None
+        next_start = lyrics.find('[', start + 1, close)
+        if next_start >= 0:
+            pos = next_start
+        elif close > start + 1:
+            return start, close
+        else:
+            pos = start + 1
+
+# Split lyrics in (tag block, name, lyrics) in a single pass, a tag block runs
+# from the first '#' up to the section header and lyrics end at the next '[' or '#'
+def _split_segments(lyrics):
+    raw_segments = []
+    pos = 0
+    while True:
+        section = _find_section(lyrics, pos)
+        if section is None:
+            return raw_segments
+        start, close = section
+
+        tag_start = lyrics.find('#', pos, start)
+        tag_block = lyrics[tag_start:start] if tag_start >= 0 else ""
+
+        end = len(lyrics)
+        for delimiter in '[#':
+            delimiter_pos = lyrics.find(delimiter, close + 1, end)
+            if delimiter_pos >= 0:
+                end = delimiter_pos
+
+        raw_segments.append((tag_block, lyrics[start + 1:close], lyrics[close + 1:end]))
+        pos = end
+
+# Split a tag block in (name, data), names are word characters directly following '#'
+def _split_tags(tag_block):
+    raw_tags = []
+    for part in tag_block.split('#')[1:]:
+        name_end = 0
+        while name_end < len(part) and (part[name_end].isalnum() or part[name_end] == '_'):
+            name_end += 1
+        if name_end > 0:
+            raw_tags.append((part[:name_end], part[name_end:]))
+    return raw_tags
+
 # Parse lyrics in segments: name, tags & lyrics
 def parse_lyrics(lyrics):
-    pattern = r"(#.*?(?=\[))?\[([^\[\]]+)\](.*?)(?=\[|\Z|#)"
-    raw_segments = re.findall(pattern, lyrics, re.DOTALL)
-    tag_pattern = r"#(\w+)(.*?)(?=#|\Z)";
+    raw_segments = _split_segments(lyrics)
 
     segments = []
     for iseg, segment in enumerate(raw_segments):
         tag_block, section_name, lyrics = segment
-        raw_tags = re.findall(tag_pattern, tag_block, re.DOTALL)
+        raw_tags = _split_tags(tag_block)
 
         tags = dict()
         
@@ -42,15 +107,18 @@ def parse_lyrics(lyrics):
     return segments    
         
 class SongSegment:
+    __slots__ = ("_idx", "_name", "_tags", "_lyrics", "_tracks", "_sig")
 
     def __init__(self):
         self._name = ""
         self._tags = {}
         self._lyrics = ""    
-        self._tracks = SongSegment.create_empty_tracks()
+        # Allocated on the first set_track, most parsed segments never hold track data
+        self._tracks = None
+        self._sig = None
 
     def create_empty_tracks():
-        return [[np.empty((0, 8 if istage == 1 else 1), dtype=np.int64) for _ in range(Song.NrTracks)] for istage in range(Song.NrStages)]
+        return [[empty_track] * Song.NrTracks for empty_track in _EMPTY_STAGE_TRACKS]
 
     def create(idx, name, tags, lyrics):
         segment = SongSegment()
@@ -58,6 +126,7 @@ class SongSegment:
         segment._name = name
         segment._tags = tags
         segment._lyrics = lyrics
+        segment._sig = None
         return segment
     
     def as_str(self):
@@ -72,31 +141,55 @@ class SongSegment:
     def name(self):
         return self._name
 
+    def _signature(self):
+        if self._sig is None:
+            self._sig = (self._name, self._lyrics, tuple(sorted(self._tags.items())))
+        return self._sig
+
     def has_changed(self, other):
-         return self._name == other._name and self._tags == other._tags and self._lyrics == other._lyrics
+        return self._signature() != other._signature()
 
     def cached_length(self, istage, itrack):
+        if self._tracks is None:
+            return 0
         return len(self._tracks[istage][itrack])
 
     def track_length(self):
         return self._tags.get('length')
 
     def set_track(self, istage, itrack, track):
+        if self._tracks is None:
+            self._tracks = SongSegment.create_empty_tracks()
         self._tracks[istage][itrack] = track
 
     def track(self, istage, itrack):
+        if self._tracks is None:
+            return _EMPTY_STAGE_TRACKS[istage]
         return self._tracks[istage][itrack]
     
     def merge(self, other):
-        self._tracks = copy.deepcopy(other._tracks)
+        if other._tracks is None:
+            self._tracks = None
+        else:
+            self._tracks = [[track.copy() for track in stage] for stage in other._tracks]
+
+    def clone(self):
+        segment = copy.copy(self)
+        segment._tags = dict(self._tags)
+        segment.merge(self)
+        return segment
+
+    def merged_stage1_tracks_np(self)->np.ndarray:
+        """
+        Interleave stage 1 track data [V V V] [I I I] -> [V I V I V I] as a contiguous array
+        """
+        return np.column_stack([self.track(0, itrack) for itrack in range(Song.NrTracks)]).ravel()
 
     def merged_stage1_tracks(self)->list[int]:
         """
         Interleave stage 1 track data [V V V] [I I I] -> [V I V I V I]
         """
-        codec_ids = np.array([track.squeeze() for track in self._tracks[0]])
-        codec_ids = rearrange(codec_ids, "b n -> (n b)", b=Song.NrTracks)
-        return codec_ids.tolist()
+        return self.merged_stage1_tracks_np().tolist()
 
 class Song():
     NrStages = 2
@@ -104,6 +197,9 @@ class Song():
     DefaultTrackLength = 1500
     DefaultSystemPrompt = "Generate music from the given lyrics segment by segment."
 
+    __slots__ = ("_segments", "_audio_prompt", "_default_track_length", "_system_prompt",
+                 "_raw_lyrics", "_lyrics", "_genre", "_original_segments", "_length")
+
     def __init__(self):
         self._segments = []
         self._audio_prompt = []
@@ -112,6 +208,8 @@ class Song():
         self._raw_lyrics = ""
         self._lyrics = ""
         self._genre = ""
+        self._original_segments = None
+        self._length = None
 
     def __str__(self):
         return self._lyrics
@@ -128,19 +226,25 @@ class Song():
     def _prepare_lyrics(self):
         new_segments = parse_lyrics(self._raw_lyrics.strip())
 
-        for iseg, segment in takewhile(lambda e: e[0] < len(self._segments), enumerate(new_segments)):
-            segment.merge(self._segments[iseg])
+        # Only carry over cached tracks for segments that were not edited
+        for new_segment, old_segment in zip(new_segments, self._segments):
+            if not new_segment.has_changed(old_segment):
+                new_segment.merge(old_segment)
 
         self._segments = new_segments
+        self._length = None
 
-        structured_lyrics = [str(seg) for seg in self._segments]
-        self._lyrics = "\n".join(structured_lyrics)
+        # Same layout as joining str(segment) with newlines, built in a single join
+        self._lyrics = "\n\n\n".join(f"[{seg._name}]\n{seg._lyrics}" for seg in self._segments)
+        if self._lyrics:
+            self._lyrics += "\n\n"
 
     def default_track_length(self):
         return self._default_track_length
 
     def set_default_track_length(self, track_length):
         self._default_track_length = track_length
+        self._length = None
 
     def set_lyrics(self, lyrics_text):
         self._raw_lyrics = lyrics_text
@@ -169,6 +273,7 @@ class Song():
 
     def remove_segment(self, segmentidx):
         del self._segments[segmentidx]
+        self._length = None
 
     def mute_segments(self, muted_segments):
         segments = [seg for seg in self._segments]
@@ -176,6 +281,7 @@ class Song():
             del segments[isegment]
         self._original_segments = self._segments
         self._segments = segments
+        self._length = None
     
     def restore_muted_segments(self):
         if self._original_segments:
@@ -187,29 +293,36 @@ class Song():
             self._segments = segments
 
             self._original_segments = None
+            self._length = None
 
     def lyrics(self):
         return self._lyrics
 
     def length(self):
-        length = 0
-        for segment in self._segments:
-            length = length + (segment.track_length() if segment.track_length() != None else self._default_track_length)
-        return length
+        if self._length is None:
+            length = 0
+            for segment in self._segments:
+                track_length = segment.track_length()
+                length = length + (track_length if track_length is not None else self._default_track_length)
+            self._length = length
+        return self._length
 
     def clear_cache(self, istage):
+        empty_track = _EMPTY_STAGE_TRACKS[istage]
+        nr_tracks = Song.NrTracks
         for segment in self._segments:
-            for itrack in range(Song.NrTracks):
-                segment.set_track(istage, itrack, [])
+            for itrack in range(nr_tracks):
+                segment.set_track(istage, itrack, empty_track)
 
     def merge_segments(self, istage):
         tracks = []
-        elem_size = 8 if istage == 1 else 1
+        empty_track = _EMPTY_STAGE_TRACKS[istage]
+        segments = self._segments
         for itrack in range(Song.NrTracks):
-            track_full = np.empty((0,elem_size), dtype=np.int64)
-            for segment in self._segments:
-                track_full = np.concatenate((track_full, segment.track(istage, itrack)))
-            tracks.append(track_full)
+            # Concatenate once, repeated concatenation re-copies all previous segments
+            parts = [empty_track]
+            parts.extend(segment.track(istage, itrack) for segment in segments)
+            tracks.append(np.concatenate(parts))
         return tracks
 
     def stage_length(self, istage):
@@ -222,9 +335,19 @@ class Song():
         return self.length() / 50
 
     def clone(self):
-        return copy.deepcopy(self)
+        song = copy.copy(self)
+        song._audio_prompt = list(self._audio_prompt)
+
+        # Muted songs share segments between both lists, keep them shared in the clone
+        clones = {id(segment): segment.clone() for segment in self._segments}
+        song._segments = [clones[id(segment)] for segment in self._segments]
+        if self._original_segments:
+            song._original_segments = [clones.get(id(segment)) or segment.clone() for segment in self._original_segments]
+        return song
 
 class GenerationCache:
+    __slots__ = ("_tracks", "_segments", "_muted_segments")
+
     def __init__(self, nr_stages: int = 2):
         self._tracks=[[] for i in range(nr_stages)]
         self._segments = []
@@ -234,7 +357,8 @@ class GenerationCache:
         self._segments.append((name, start, end))
 
     def add_tracks(self, stageidx: int, tracks: list):
-        self._tracks[stageidx] = tracks
+        # Keep tracks as int64 arrays so transfer_to_song slices are views, not copies
+        self._tracks[stageidx] = [np.asarray(track, dtype=np.int64) for track in tracks]
 
     def split_last_segment(self, new_name: str):
         if self._segments:
@@ -297,7 +421,7 @@ class GenerationCache:
             length = end - start
             if tokens > length:
                 tokens = tokens - length
-                self._segments = self._segments[:-1]
+                self._segments.pop()
             else:
                 self._segments[iseg] = (name, start, end - tokens)
                 return
@@ -323,21 +447,25 @@ class GenerationCache:
 
     def transfer_to_song(self, song: Song):
         nr_segments = len(song)
-        for isegment, segment in enumerate(self._segments):
+        stage_tracks = [[self.track(istage, itrack) for itrack in range(Song.NrTracks)] for istage in range(Song.NrStages)]
+        stage_track_lengths = [[len(track) for track in tracks] for tracks in stage_tracks]
+
+        for isegment, segment in enumerate(self._segments[:nr_segments]):
             _, start_pos, end_pos = segment
-            if isegment < nr_segments:
-                for istage in range(Song.NrStages):
-                    for itrack in range(Song.NrTracks):
-                        track = self.track(istage, itrack) 
+            song_segment = song[isegment]
+            for istage, tracks in enumerate(stage_tracks):
+                track_lengths = stage_track_lengths[istage]
+                for itrack, track in enumerate(tracks):
+                    track_length = track_lengths[itrack]
+
+                    if start_pos > track_length or track_length == 0:
+                        continue
 
-                        if start_pos > len(track) or len(track) == 0:
-                            continue
+                    # Stage 2 might contain less data than Stage 1
+                    if end_pos > track_length:
+                        end_pos = track_length
 
-                        # Stage 2 might contain less data than Stage 1
-                        if end_pos > len(track):
-                            end_pos = len(track)
-                        
-                        song[isegment].set_track(istage, itrack, track[start_pos:end_pos])
+                    song_segment.set_track(istage, itrack, track[start_pos:end_pos])
 
     def save(self):
         data = dict()
@@ -345,10 +473,14 @@ class GenerationCache:
         for stage in self._tracks:
             tracks = []
             for track in stage:
-                tracks.append(track.flatten().tolist())
+                # Token ids fit in 32 bits, store them packed instead of as a list of ints
+                tracks.append({
+                    "shape": list(track.shape),
+                    "data": base64.b64encode(np.ascontiguousarray(track, dtype=_SAVED_TRACK_DTYPE).tobytes()).decode("ascii"),
+                })
             stage_tracks.append(tracks)
         data["tracks"] = stage_tracks
-        data["segments"] = copy.deepcopy(self._segments)
+        data["segments"] = list(self._segments)
         data["muted_segments"] = list(self._muted_segments)
         return data
 
@@ -359,6 +491,11 @@ class GenerationCache:
             tracks = []
             elem_size = 8 if istage == 1 else 1
             for track in stage:
+                if isinstance(track, dict):
+                    packed = np.frombuffer(base64.b64decode(track["data"]), dtype=_SAVED_TRACK_DTYPE)
+                    tracks.append(packed.astype(np.int64).reshape(track["shape"]))
+                    continue
+                # Caches saved as flat lists of ints
                 nr_elements = (len(track) // elem_size)
                 aligned_size = nr_elements * elem_size
                 tracks.append(np.array(track[:aligned_size], dtype=np.int64).reshape((nr_elements, elem_size)))